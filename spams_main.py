@@ -1,14 +1,151 @@
 import argparse
 import os
+import shutil
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import utils
 
 
+def meteo_station_cache(df_meteo):
+    """Daily meteo data of each station as contiguous arrays.
+
+    Parameters
+    ----------
+    df_meteo : pd.DataFrame
+        Daily precipitation and evapotranspiration of the meteo stations,
+        indexed and sorted by meteo_id and datum.
+
+    Returns
+    -------
+    dict
+        Precipitation (mm), evapotranspiration (mm), and dates keyed by
+        meteo station ID.
+    """
+    return {
+        meteo_id: (
+            g["precip"].to_numpy(dtype=np.float32),
+            g["evapo"].to_numpy(dtype=np.float32),
+            g.index.get_level_values("datum").to_numpy(),
+        )
+        for meteo_id, g in df_meteo.groupby(level="meteo_id", sort=False)
+    }
+
+
+def meteo_window(dates, meteo_id, first, last):
+    """Position of a complete daily meteo window in the dates of a station.
+
+    Parameters
+    ----------
+    dates : np.array
+        Sorted dates of the meteo station.
+    meteo_id : int
+        Meteo station ID.
+    first : pd.Timestamp
+        First required date.
+    last : pd.Timestamp
+        Last required date.
+
+    Returns
+    -------
+    int
+        Start and stop position of the window in dates.
+
+    Raises
+    ------
+    ValueError
+        If the station does not have exactly one value for every day
+        between first and last.
+    """
+    lo = np.searchsorted(dates, first.to_datetime64(), side="left")
+    hi = np.searchsorted(dates, last.to_datetime64(), side="right")
+    n_days = (last - first).days + 1
+
+    if (
+        hi - lo != n_days
+        or dates[lo] != first.to_datetime64()
+        or dates[hi - 1] != last.to_datetime64()
+    ):
+        missing = pd.date_range(first, last).difference(pd.DatetimeIndex(dates[lo:hi]))
+        if missing.empty:
+            raise ValueError(
+                f"Meteo station {meteo_id} has duplicate days between "
+                f"{first:%Y-%m-%d} and {last:%Y-%m-%d}"
+            )
+        raise ValueError(
+            f"Meteo station {meteo_id} is missing {missing.size} days of data "
+            f"between {missing[0]:%Y-%m-%d} and {missing[-1]:%Y-%m-%d}"
+        )
+
+    return lo, hi
+
+
+def spams_all_parcels(xP, xE, xI, tau, meteo_ids, station_cache, epoch):
+    """Compute SPAMS model for all parcels.
+
+    Parameters
+    ----------
+    xP : np.array
+        Scaling factor for precipitation (mm/mm) per parcel.
+    xE : np.array
+        Scaling factor for evapotranspiration (mm/mm) per parcel.
+    xI : np.array
+        Irreversible constant, active during dry period (mm/day) per parcel.
+    tau : np.array
+        Time constant (days) per parcel.
+    meteo_ids : np.array
+        Meteo station ID of each parcel.
+    station_cache : dict
+        Daily meteo data of each station from meteo_station_cache.
+    epoch : pd.DatetimeIndex
+        Time series dates.
+
+    Returns
+    -------
+    np.array
+        Reversible, irreversible, and relative height in mm with one parcel
+        per row.
+    """
+    ## Longest time constant of the parcels of each station
+    station_ids, station_idx = np.unique(meteo_ids, return_inverse=True)
+    station_tau = np.zeros(station_ids.size, dtype=np.int64)
+    np.maximum.at(station_tau, station_idx, tau)
+
+    ## Meteo data of each station, covering every day up to the end date
+    precip = [None] * station_ids.size
+    evapo = [None] * station_ids.size
+    for k, meteo_id in enumerate(station_ids):
+        if meteo_id not in station_cache:
+            raise ValueError(f"No meteo data found for meteo station {meteo_id}")
+        station_precip, station_evapo, dates = station_cache[meteo_id]
+        first = epoch[0] - timedelta(days=int(station_tau[k]) - 1)
+        lo, hi = meteo_window(dates, meteo_id, first, epoch[-1])
+        precip[k] = station_precip[lo:hi]
+        evapo[k] = station_evapo[lo:hi]
+    lengths = np.array([p.size for p in precip])
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    return utils.spams_model_parcels(
+        xP,
+        xE,
+        xI,
+        tau,
+        station_idx,
+        np.concatenate(precip),
+        np.concatenate(evapo),
+        offsets,
+        lengths,
+        epoch.size,
+    )
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -45,83 +182,217 @@ def main():
         "-pid",
         help="int, parcel ID (optional). It will take a random parcel if it is empty",
     )
+    parser.add_argument(
+        "--output_filepath",
+        "-out_fp",
+        help="str, path to the output parquet file (optional). If specified, the SPAMS model of all parcels is written to this file instead of plotting one parcel",
+    )
+    parser.add_argument(
+        "--summary_filepath",
+        "-sum_fp",
+        help="str, path to the output parquet file with the yearly irreversible rate and F-value of all parcels (optional, used with --output_filepath)",
+    )
+    parser.add_argument(
+        "--figure_filepath",
+        "-fig_fp",
+        help="str, path to save the figure (optional). If specified, the figure is saved without opening a window",
+    )
 
     args = parser.parse_args()
 
-    ## Load SPAMS parameters
-    df_spams = pd.read_parquet(args.spams10_filepath)
-    pnt_ids = df_spams["pnt_id"].unique()
+    ## Load SPAMS parameters, reading only the needed columns
+    if args.output_filepath is not None:
+        df_spams = pd.read_parquet(
+            args.spams10_filepath,
+            columns=[
+                "pnt_id",
+                "xP",
+                "xE",
+                "xI",
+                "tau",
+                "meteo_id",
+                "var_xI",
+                "rss",
+                "dof",
+            ],
+        )
+    else:
+        ## Select a parcel and read only its row
+        if args.parcel_id is None:
+            pnt_ids = pd.read_parquet(args.spams10_filepath, columns=["pnt_id"])
+            pid = np.random.choice(pnt_ids["pnt_id"].unique())
+        else:
+            pid = np.int32(args.parcel_id)
+        df_spams_sel = pd.read_parquet(
+            args.spams10_filepath,
+            columns=[
+                "pnt_id",
+                "xP",
+                "xE",
+                "xI",
+                "tau",
+                "meteo_id",
+                "var_xP",
+                "var_xE",
+                "var_xI",
+                "pnt_lon",
+                "pnt_lat",
+                "rss",
+                "dof",
+            ],
+            filters=[("pnt_id", "==", int(pid))],
+        ).set_index("pnt_id")
 
     ## Time series dates
     start = pd.to_datetime(datetime.strptime(str(args.start_date), "%Y%m%d"))
     end = pd.to_datetime(datetime.strptime(str(args.end_date), "%Y%m%d"))
     epoch = pd.date_range(start=start, end=end)
 
-    ## Select a parcel
-    if args.parcel_id is None:
-        pid = np.random.choice(pnt_ids)
+    ## Meteo stations and first meteo date needed by the parcels
+    if args.output_filepath is not None:
+        station_ids = df_spams["meteo_id"].unique()
+        max_tau = int(df_spams["tau"].max())
     else:
-        pid = np.int32(args.parcel_id)
-    df_spams_sel = df_spams[df_spams["pnt_id"] == pid]
+        station_ids = [df_spams_sel.at[pid, "meteo_id"]]
+        max_tau = int(df_spams_sel.at[pid, "tau"])
+    meteo_start = start - timedelta(days=max_tau - 1)
+
+    ## Load meteo data, from the partitioned KNMI dataset if it holds the same
+    ## stations as the KNMI files and is newer than all of them, otherwise parse
+    ## the KNMI files and rewrite the dataset
+    if args.meteo_filename is None:
+        filelist = sorted(Path(args.meteo_dir).glob("**/etmgeg_*.txt"))
+        knmi_dataset = Path(args.meteo_dir) / "knmi_parquet"
+        parts = list(knmi_dataset.glob("meteo_id=*/*.parquet"))
+        file_stations = {f.stem.removeprefix("etmgeg_") for f in filelist}
+        dataset_stations = {p.parent.name.removeprefix("meteo_id=") for p in parts}
+        if (
+            parts
+            and file_stations == dataset_stations
+            and min(p.stat().st_mtime for p in parts)
+            > max((f.stat().st_mtime for f in filelist), default=0)
+        ):
+            df_meteo = utils.read_knmi_dataset(
+                knmi_dataset, station_ids, meteo_start, end
+            )
+        else:
+            if not filelist:
+                raise ValueError(
+                    f"No KNMI files etmgeg_*.txt found in {args.meteo_dir}"
+                )
+            with ThreadPoolExecutor(max_workers=min(16, len(filelist))) as executor:
+                df_meteo = pd.concat(executor.map(utils.read_knmi, filelist))
+
+            ## The dataset is only a cache, so carry on without it if the meteo
+            ## directory is not writable
+            try:
+                shutil.rmtree(knmi_dataset, ignore_errors=True)
+                utils.write_knmi_dataset(df_meteo, knmi_dataset)
+            except OSError as e:
+                warnings.warn(f"Could not write the KNMI dataset {knmi_dataset}: {e}")
+    else:
+        df_meteo = utils.read_knmi(os.path.join(args.meteo_dir, args.meteo_filename))
+    df_meteo = df_meteo.set_index(["meteo_id", "datum"]).sort_index()
+
+    ## Compute SPAMS model for all parcels
+    if args.output_filepath is not None:
+        ## SPAMS model parameters of all parcels as flat arrays
+        pnt_id = df_spams["pnt_id"].to_numpy()
+        xP = df_spams["xP"].to_numpy(dtype=np.float64)
+        xE = df_spams["xE"].to_numpy(dtype=np.float64)
+        xI = df_spams["xI"].to_numpy(dtype=np.float64)
+        tau = df_spams["tau"].to_numpy(dtype=np.int64)
+        if args.meteo_filename is None:
+            meteo_ids = df_spams["meteo_id"].to_numpy()
+        else:
+            meteo_ids = np.full(pnt_id.size, df_meteo.index[0][0])
+
+        reversible, irreversible, height = spams_all_parcels(
+            xP, xE, xI, tau, meteo_ids, meteo_station_cache(df_meteo), epoch
+        )
+        ## Write the (parcels x days) outputs as flat columns without copying them
+        ts_spams = pa.table(
+            {
+                "pnt_id": np.repeat(pnt_id, epoch.size),
+                "epoch": np.tile(epoch.to_numpy(), pnt_id.size),
+                "reversible": reversible.ravel(),
+                "irreversible": irreversible.ravel(),
+                "height": height.ravel(),
+            }
+        )
+        pq.write_table(ts_spams, args.output_filepath)
+
+        ## Mean irreversible rate and F-value of all parcels
+        if args.summary_filepath is not None:
+            vI, std_vI = utils.irreversible_rate(
+                irreversible, xI, df_spams["var_xI"].to_numpy()
+            )
+            F = utils.f_value(df_spams["rss"].to_numpy(), df_spams["dof"].to_numpy())
+            pd.DataFrame(
+                {"pnt_id": pnt_id, "vI": vI, "std_vI": std_vI, "F": F}
+            ).to_parquet(args.summary_filepath)
+        return
 
     ## SPAMS model parameters of the selected parcel
-    xP = df_spams_sel["xP"].values[0]
-    xE = df_spams_sel["xE"].values[0]
-    xI = df_spams_sel["xI"].values[0]
-    t = int(df_spams_sel["tau"].values[0])
+    xP = df_spams_sel.at[pid, "xP"]
+    xE = df_spams_sel.at[pid, "xE"]
+    xI = df_spams_sel.at[pid, "xI"]
+    t = int(df_spams_sel.at[pid, "tau"])
 
     ## SPAMS model parameters stdev of the selected parcel
-    std_xP = np.sqrt(df_spams_sel["var_xP"].values[0])
-    std_xE = np.sqrt(df_spams_sel["var_xE"].values[0])
-    std_xI = np.sqrt(df_spams_sel["var_xI"].values[0])
+    std_xP = np.sqrt(df_spams_sel.at[pid, "var_xP"])
+    std_xE = np.sqrt(df_spams_sel.at[pid, "var_xE"])
+    std_xI = np.sqrt(df_spams_sel.at[pid, "var_xI"])
 
-    ## Load and subset meteo data
+    ## Subset meteo data with binary searches on the station dates
     if args.meteo_filename is None:
-        filelist = sorted(Path(args.meteo_dir).glob("**/etmgeg_*.txt"))
-        f1 = [None] * len(filelist)
-        for i, file in enumerate(filelist):
-            f1[i] = utils.read_knmi(file)
-        df_meteo = pd.concat(f1)
-
-        meteo_id = df_spams_sel["meteo_id"].values[0]
-
-        meteo_subset = df_meteo.loc[
-            (df_meteo["meteo_id"] == meteo_id)
-            & (df_meteo["datum"] > (start - timedelta(days=t)))
-            & (df_meteo["datum"] <= end)
-        ].reset_index(drop=True)
+        meteo_id = df_spams_sel.at[pid, "meteo_id"]
     else:
-        df_meteo = utils.read_knmi(os.path.join(args.meteo_dir, args.meteo_filename))
+        meteo_id = df_meteo.index[0][0]
 
-        meteo_subset = df_meteo.loc[
-            (df_meteo["datum"] > (start - timedelta(days=t)))
-            & (df_meteo["datum"] <= end)
-        ].reset_index(drop=True)
+    station_cache = meteo_station_cache(df_meteo.loc[meteo_id:meteo_id])
+    if meteo_id not in station_cache:
+        raise ValueError(f"No meteo data found for meteo station {meteo_id}")
+    precip, evapo, dates = station_cache[meteo_id]
+    lo, hi = meteo_window(dates, meteo_id, start - timedelta(days=t - 1), end)
+    meteo_subset = pd.DataFrame({"precip": precip[lo:hi], "evapo": evapo[lo:hi]})
 
     ## Compute SPAMS model and mean irreversible rate
     reversible, irreversible, height = utils.spams_model(xP, xE, xI, t, meteo_subset)
     vI, std_vI = utils.irreversible_rate(
-        irreversible, xI, df_spams_sel["var_xI"].values[0]
+        irreversible, xI, df_spams_sel.at[pid, "var_xI"]
     )
 
     ## Compute F-value
-    F = utils.f_value(df_spams_sel["rss"].values[0], df_spams_sel['dof'].values[0])
+    F = utils.f_value(df_spams_sel.at[pid, "rss"], df_spams_sel.at[pid, 'dof'])
 
-    ## Plot for a parcel
+    ## Plot for a parcel, without a GUI backend when only saving the figure
+    if args.figure_filepath is not None:
+        plt.switch_backend("Agg")
     fig, ax1 = plt.subplots(figsize=(12, 6))
 
-    ax1.plot(epoch, height, "-k", markersize=2, label="Total")
-    ax1.plot(epoch, reversible, "-.C7", markersize=2, label="Reversible")
-    ax1.plot(epoch, irreversible, "--C7", linewidth=2, label="Irreversible")
+    ## Decimate long time series to about the figure width in pixels
+    stride = max(1, epoch.size // 1500)
+    ax1.plot(epoch[::stride], height[::stride], "-k", markersize=2, label="Total")
+    ax1.plot(
+        epoch[::stride], reversible[::stride], "-.C7", markersize=2, label="Reversible"
+    )
+    ax1.plot(
+        epoch[::stride],
+        irreversible[::stride],
+        "--C7",
+        linewidth=2,
+        label="Irreversible",
+    )
 
     ax1.set_ylabel("Relative surface elevation (mm)", fontsize=9)
     ax1.grid(linestyle="--", alpha=0.5)
-    ax1.set_ylim(ymin=min(height) - 50, ymax=max(height) + 50)
+    ax1.set_ylim(ymin=np.nanmin(height) - 50, ymax=np.nanmax(height) + 50)
 
     ## Add information using text boxes
     info_text = (
         f"Parcel ID: {pid}\n"
-        f"Loc (lon, lat): {round(df_spams_sel['pnt_lon'].values[0], 4)}, {round(df_spams_sel['pnt_lat'].values[0], 4)}\n"
+        f"Loc (lon, lat): {round(df_spams_sel.at[pid, 'pnt_lon'], 4)}, {round(df_spams_sel.at[pid, 'pnt_lat'], 4)}\n"
         f"F-value = {round(F, 2)}\n"
         f"SPAMS parameters:\n"
         f"\t$x_P$ = {utils.format_with_uncertainty(xP, std_xP)}\n"
@@ -158,33 +429,34 @@ def main():
     )
 
     ## Meteorological data plot
-    meteo_subset = df_meteo.loc[
-        (df_meteo["datum"] > start) & (df_meteo["datum"] <= end)
-    ].reset_index(drop=True)
+    lo = np.searchsorted(dates, start.to_datetime64(), "right")
 
     ax2 = ax1.twinx()
     ax2.bar(
-        meteo_subset["datum"],
-        meteo_subset["precip"],
+        dates[lo:hi],
+        precip[lo:hi],
         color="blue",
         label="Daily precip.",
     )
     ax2.bar(
-        meteo_subset["datum"],
-        -meteo_subset["evapo"],
+        dates[lo:hi],
+        -evapo[lo:hi],
         color="red",
         label="Daily evapo. (negative)",
     )
 
     ax2.set_ylabel("Daily precip. / evapo. amount (mm)", fontsize=9)
     ax2.set_ylim(
-        ymin=max(meteo_subset["evapo"]) * -1 - 5,
-        ymax=max(meteo_subset["precip"]) + 30,
+        ymin=np.nanmax(evapo[lo:hi]) * -1 - 5,
+        ymax=np.nanmax(precip[lo:hi]) + 30,
     )
 
     fig.legend(bbox_to_anchor=(0.94, 0.97), fontsize=8)
     fig.tight_layout()
-    plt.show()
+    if args.figure_filepath is not None:
+        fig.savefig(args.figure_filepath)
+    else:
+        plt.show()
 
 
 if __name__ == "__main__":
@@ -2,6 +2,9 @@ import math
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from numba import njit, prange
 
 
 def spams_model(xP, xE, xI, tau, meteo_df):
@@ -31,47 +34,209 @@ def spams_model(xP, xE, xI, tau, meteo_df):
     float
         Relative height, reversible, and irreversible in mm.
     """
-    ## Get daily precipitation and evapotranspiration
-    p = np.lib.stride_tricks.sliding_window_view(meteo_df["precip"], tau)
-    e = np.lib.stride_tricks.sliding_window_view(meteo_df["evapo"], tau)
+    ## Fixed argument types, so a single compiled kernel is reused from the cache
+    precip = np.ascontiguousarray(meteo_df["precip"], dtype=np.float32)
+    evapo = np.ascontiguousarray(meteo_df["evapo"], dtype=np.float32)
+    tau = int(tau)
+
+    n = precip.size - tau + 1
+    reversible = np.empty(n, dtype=np.float32)
+    irreversible = np.empty(n, dtype=np.float32)
+    height = np.empty(n, dtype=np.float32)
+    _spams_kernel(
+        precip,
+        evapo,
+        float(xP),
+        float(xE),
+        float(xI),
+        tau,
+        reversible,
+        irreversible,
+        height,
+    )
+
+    return reversible, irreversible, height
 
-    ## Reversible
-    reversible = np.sum(xP * p - xE * e, axis=1)
 
-    ## Irreversible
-    dry_flag = np.zeros(reversible.size)
-    dry_flag[reversible < 0] = 1
-    irreversible = np.cumsum(xI * dry_flag)
+def spams_model_parcels(
+    xP, xE, xI, tau, station_idx, precip, evapo, offsets, lengths, n_out
+):
+    """Compute SPAMS model for many parcels in parallel.
 
-    ## Relative height in m
-    height = reversible + irreversible
+    The meteo data of all stations are concatenated in precip and evapo. Each
+    parcel uses the last n_out + tau - 1 days of its station, so the last day
+    of every station is the last modelled day.
+
+    Parameters
+    ----------
+    xP : np.array
+        Scaling factor for precipitation (mm/mm) per parcel.
+    xE : np.array
+        Scaling factor for evapotranspiration (mm/mm) per parcel.
+    xI : np.array
+        Irreversible constant, active during dry period (mm/day) per parcel.
+    tau : np.array
+        Time constant (days) per parcel.
+    station_idx : np.array
+        Index of the meteo station of each parcel in offsets and lengths.
+    precip : np.array
+        Daily precipitation (mm) of all stations.
+    evapo : np.array
+        Daily evapotranspiration (mm) of all stations.
+    offsets : np.array
+        Position of the first day of each station in precip and evapo.
+    lengths : np.array
+        Number of days of each station in precip and evapo.
+    n_out : int
+        Number of modelled days.
+
+    Returns
+    -------
+    np.array
+        Reversible, irreversible, and relative height in mm with shape
+        (number of parcels, n_out).
+    """
+    ## Fixed argument types, so a single compiled driver is reused from the cache
+    xP = np.ascontiguousarray(xP, dtype=np.float64)
+    xE = np.ascontiguousarray(xE, dtype=np.float64)
+    xI = np.ascontiguousarray(xI, dtype=np.float64)
+    tau = np.ascontiguousarray(tau, dtype=np.int64)
+    station_idx = np.ascontiguousarray(station_idx, dtype=np.int64)
+    precip = np.ascontiguousarray(precip, dtype=np.float32)
+    evapo = np.ascontiguousarray(evapo, dtype=np.float32)
+    offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+    lengths = np.ascontiguousarray(lengths, dtype=np.int64)
+
+    short = np.flatnonzero(lengths[station_idx] < n_out + tau - 1)
+    if short.size > 0:
+        i = short[0]
+        raise ValueError(
+            f"Not enough meteo data in station index {station_idx[i]} for the time "
+            f"constant of parcel {i} ({tau[i]} days)"
+        )
+
+    reversible = np.empty((xP.size, n_out), dtype=np.float32)
+    irreversible = np.empty((xP.size, n_out), dtype=np.float32)
+    height = np.empty((xP.size, n_out), dtype=np.float32)
+    _spams_parcels(
+        xP,
+        xE,
+        xI,
+        tau,
+        station_idx,
+        precip,
+        evapo,
+        offsets,
+        lengths,
+        reversible,
+        irreversible,
+        height,
+    )
 
     return reversible, irreversible, height
 
 
+@njit(cache=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"})
+def _spams_kernel(precip, evapo, xP, xE, xI, tau, reversible, irreversible, height):
+    """Reversible, irreversible, and relative height in a single pass.
+
+    The reversible part is a running sum over a window of tau days. Missing
+    meteo values (NaN) are counted instead of summed, so only the windows
+    containing them become NaN. The fastmath flags exclude "nnan" and "ninf"
+    to keep these checks. The inputs and outputs may be float32, the running
+    sums are kept in float64 so long series do not drift.
+    """
+    w = 0.0
+    n_nan = 0
+    acc = 0.0
+    for j in range(precip.size):
+        ## Add the newest day to the window
+        s = xP * precip[j] - xE * evapo[j]
+        if np.isnan(s):
+            n_nan += 1
+        else:
+            w += s
+
+        ## Remove the day leaving the window
+        if j >= tau:
+            s = xP * precip[j - tau] - xE * evapo[j - tau]
+            if np.isnan(s):
+                n_nan -= 1
+            else:
+                w -= s
+
+        if j >= tau - 1:
+            i = j - tau + 1
+            rev = np.nan if n_nan > 0 else w
+
+            ## Irreversible: accumulate xI during dry periods, written as a
+            ## select so it compiles to a conditional move instead of a branch
+            acc += xI if rev < 0.0 else 0.0
+
+            reversible[i] = rev
+            irreversible[i] = acc
+            height[i] = rev + acc
+
+
+@njit(cache=True, parallel=True)
+def _spams_parcels(
+    xP,
+    xE,
+    xI,
+    tau,
+    station_idx,
+    precip,
+    evapo,
+    offsets,
+    lengths,
+    reversible,
+    irreversible,
+    height,
+):
+    """Run _spams_kernel for every parcel, distributing parcels over threads."""
+    n_out = reversible.shape[1]
+    for i in prange(xP.size):
+        k = station_idx[i]
+        stop = offsets[k] + lengths[k]
+        begin = stop - (n_out + tau[i] - 1)
+        _spams_kernel(
+            precip[begin:stop],
+            evapo[begin:stop],
+            xP[i],
+            xE[i],
+            xI[i],
+            tau[i],
+            reversible[i],
+            irreversible[i],
+            height[i],
+        )
+
+
 def irreversible_rate(irreversible, xI, var_xI):
     """Irreversible rate in mm/year
 
     Parameters
     ----------
     irreversible : np.array
-        SPAMS time series model for irreversible part.
-    xI : float
+        SPAMS time series model for irreversible part. For several parcels,
+        one parcel per row.
+    xI : float or np.array
         Irreversible constant, active during dry period (mm/day).
-    var_xI : float
+    var_xI : float or np.array
         Variance of the irreversible constant.
 
     Returns
     -------
-    float
+    float or np.array
         Mean irreversible rate per year and its variance.
     """
-    ## Dry flag: integer boolean masking the dry periods with 1
-    dry_flag = np.insert(np.diff(irreversible / xI), 0, 0)
+    ## Number of dry days after the first day
+    n_dry = (irreversible[..., -1] - irreversible[..., 0]) / xI
 
     ## Linear irreversible rate per year and its standard deviation
-    vI = irreversible[-1] / (irreversible.shape[0] / 365.25)
-    std_vI = np.sqrt(var_xI) * (np.sum(dry_flag) / (irreversible.shape[0] / 365.25))
+    years = irreversible.shape[-1] / 365.25
+    vI = irreversible[..., -1] / years
+    std_vI = np.sqrt(var_xI) * (n_dry / years)
 
     return vI, std_vI
 
@@ -89,14 +254,14 @@ def f_value(rss, dof):
 
     Parameters
     ----------
-    rss : float
+    rss : float or np.array
         The weighted residual sum of squares (rss).
-    dof : int
+    dof : int or np.array
         Degree of freedom.
 
     Returns
     -------
-    float
+    float or np.array
         F-value.
     """
     return rss / dof
@@ -122,26 +287,95 @@ def read_knmi(file):
     pd.DataFrame
         Daily precipitation and evapotranspiration.
     """
-    df_meteo = pd.DataFrame(
-        data=np.genfromtxt(
-            file,
-            delimiter=",",
-            skip_header=53,
-            missing_values="",
-            filling_values=np.nan,
-            usecols=(0, 1, 22, 40),
-        ),
-        columns=["meteo_id", "datum", "precip", "evapo"],
+    df_meteo = pd.read_csv(
+        file,
+        header=None,
+        skiprows=53,
+        comment="#",
+        skipinitialspace=True,
+        usecols=[0, 1, 22, 40],
+        names=["meteo_id", "datum", "precip", "evapo"],
+        dtype={
+            "meteo_id": np.int64,
+            "datum": np.int64,
+            "precip": np.float32,
+            "evapo": np.float32,
+        },
     )
 
-    df_meteo["meteo_id"] = df_meteo["meteo_id"].astype(int)
-    df_meteo["datum"] = pd.to_datetime(df_meteo["datum"].astype(str), format="%Y%m%d.0")
-    df_meteo["precip"] = df_meteo["precip"] / 10  # mm
-    df_meteo["evapo"] = df_meteo["evapo"] / 10  # mm
+    ymd = df_meteo["datum"]
+    df_meteo["datum"] = pd.to_datetime(
+        pd.DataFrame(
+            {"year": ymd // 10000, "month": ymd // 100 % 100, "day": ymd % 100}
+        )
+    )
+    df_meteo["precip"] = df_meteo["precip"] / np.float32(10)  # mm
+    df_meteo["evapo"] = df_meteo["evapo"] / np.float32(10)  # mm
 
     return df_meteo
 
 
+def write_knmi_dataset(df_meteo, root):
+    """Write KNMI meteo data as a parquet dataset partitioned by meteo station.
+
+    Each station is written to its own meteo_id=<ID> directory, so that
+    read_knmi_dataset only touches the files of the requested stations.
+    Stations already in the dataset are overwritten.
+
+    Parameters
+    ----------
+    df_meteo : pd.DataFrame
+        Daily precipitation and evapotranspiration from read_knmi.
+    root : str
+        Path to the dataset directory.
+    """
+    df_meteo.to_parquet(
+        root,
+        compression="zstd",
+        index=False,
+        partition_cols=["meteo_id"],
+        existing_data_behavior="delete_matching",
+    )
+
+
+def read_knmi_dataset(root, meteo_ids=None, start=None, end=None):
+    """Read KNMI meteo data from a parquet dataset written by write_knmi_dataset.
+
+    The station and date filters are applied while scanning the dataset, so
+    only the needed partitions and row groups are loaded.
+
+    Parameters
+    ----------
+    root : str
+        Path to the dataset directory.
+    meteo_ids : list of int, optional
+        Meteo station IDs to read. All stations are read if it is None.
+    start : pd.Timestamp, optional
+        First date to read.
+    end : pd.Timestamp, optional
+        Last date to read.
+
+    Returns
+    -------
+    pd.DataFrame
+        Daily precipitation and evapotranspiration.
+    """
+    dataset = ds.dataset(root, format="parquet", partitioning="hive")
+    datum_type = dataset.schema.field("datum").type
+
+    expr = ds.scalar(True)
+    if meteo_ids is not None:
+        expr &= ds.field("meteo_id").isin([int(m) for m in meteo_ids])
+    if start is not None:
+        expr &= ds.field("datum") >= pa.scalar(start, type=datum_type)
+    if end is not None:
+        expr &= ds.field("datum") <= pa.scalar(end, type=datum_type)
+
+    return dataset.to_table(
+        columns=["meteo_id", "datum", "precip", "evapo"], filter=expr
+    ).to_pandas()
+
+
 def format_with_uncertainty(value, uncertainty):
     """Format a value with its uncertainty.
 
@@ -163,17 +397,14 @@ def format_with_uncertainty(value, uncertainty):
     if uncertainty == 0:
         return f"{value}"  # No uncertainty to display
 
-    ## Determine the order of magnitude of the uncertainty
-    order_of_magnitude = -int(math.floor(math.log10(abs(uncertainty))))
-
-    ## Round the uncertainty to 1 significant figure
-    rounded_uncertainty = round(uncertainty, order_of_magnitude)
-
-    ## Round the value to match the decimal place of the rounded uncertainty
-    rounded_value = round(value, order_of_magnitude)
+    ## Decimal place of the first significant figure of the uncertainty
+    decimals = -math.floor(math.log10(abs(uncertainty)))
 
-    ## Format as a string
-    formatted_value = f"{rounded_value:.{order_of_magnitude}f}"
-    formatted_uncertainty = f"{rounded_uncertainty:.{order_of_magnitude}f}"
+    ## Uncertainties of 1 or more are rounded to units, tens, ... without decimals
+    if decimals <= 0:
+        value = round(value, decimals)
+        uncertainty = round(uncertainty, decimals)
+        decimals = 0
 
-    return f"{formatted_value} $\pm$ {formatted_uncertainty}"
+    ## Fixed-point formatting rounds both to the decimal place of the uncertainty
+    return f"{value:.{decimals}f} $\\pm$ {uncertainty:.{decimals}f}"